@@ -1,29 +1,63 @@
-from flask import Flask, request, jsonify, session, send_from_directory
+import eventlet
+eventlet.monkey_patch()  # must run before anything else imports socket/threading
+from flask import Flask, Response, request, jsonify, session, send_from_directory
 from flask_socketio import SocketIO, emit, join_room
 from flask_cors import CORS
-import eventlet
-eventlet.monkey_patch()
+from flask_compress import Compress
+import orjson
+from eventlet import semaphore, tpool
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
 import secrets
 import sqlite3
 import hashlib
+import gzip
+import hmac
 import os
 import re
 import time
+import queue
+import atexit
+import threading
 import logging
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__, static_folder='.', static_url_path='')
-app.config['SECRET_KEY'] = secrets.token_hex(32)
+# No built-in static route: its /<path:filename> rule would shadow serve() below, so every file goes through serve()
+app = Flask(__name__, static_folder=None)
+# render.yaml provides SECRET_KEY; a stable key lets every worker and restart verify the same session cookies
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or secrets.token_hex(32)
 app.config['SESSION_COOKIE_SAMESITE'] = 'None'
 app.config['SESSION_COOKIE_SECURE'] = True
 app.config['SESSION_COOKIE_HTTPONLY'] = False
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=30)
+# Static assets (js/images) are not fingerprinted, so cache for a day and revalidate by ETag after that
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = timedelta(days=1)
+
+class OrjsonWrapper:
+    """json module shim for Socket.IO packets - orjson encodes in C and handles datetime natively."""
+    @staticmethod
+    def dumps(obj, *args, **kwargs): return orjson.dumps(obj).decode()
+    @staticmethod
+    def loads(s, *args, **kwargs): return orjson.loads(s)
 
 CORS(app, supports_credentials=True, origins="*")
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
+Compress(app)
+# ✅ REDIS_URL enables the Socket.IO message queue so room emits reach clients on every worker
+REDIS_URL = os.environ.get('REDIS_URL')
+# Own pub/sub channel so other apps sharing the same Redis never see (or flood) our packets
+SOCKETIO_CHANNEL = os.environ.get('SOCKETIO_CHANNEL', 'chylnx-socketio')
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet', json=OrjsonWrapper,
+                    message_queue=REDIS_URL, channel=SOCKETIO_CHANNEL)
+# In-process caches only see this worker's writes; with several workers they are re-read on this TTL instead
+SHARED_STATE_TTL = 5 if REDIS_URL else None
+
+def is_stale(loaded_at):
+    return SHARED_STATE_TTL is not None and time.monotonic() - loaded_at > SHARED_STATE_TTL
 
 # ✅ PERSISTENT DATABASE - survives Render restarts
 DB_DIR = os.environ.get('RENDER_DISK_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
@@ -31,15 +65,173 @@ os.makedirs(DB_DIR, exist_ok=True)
 DB_PATH = os.path.join(DB_DIR, 'chylnx.db')
 logger.info(f"📁 Database: {DB_PATH}")
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
+# ✅ CONNECTION POOL - connections are reused instead of reopened per query
+# Keep this small: SQLite allows one writer at a time, extra connections only wait on the lock
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+DB_BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', 5))
+DB_STATEMENT_CACHE = 256
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, cached_statements=DB_STATEMENT_CACHE, check_same_thread=False)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA journal_mode=WAL")
     conn.execute("PRAGMA synchronous=NORMAL")
     return conn
 
+@contextmanager
+def get_db(commit=False):
+    try: conn = _db_pool.get_nowait()
+    except queue.Empty: conn = _connect()
+    broken = False
+    try:
+        yield conn
+        if commit: conn.commit()
+    except:
+        try: conn.rollback()
+        except sqlite3.Error: broken = True
+        raise
+    finally:
+        if broken: conn.close()
+        else:
+            # A write left uncommitted would keep SQLite's write lock while the connection sits in the pool
+            if conn.in_transaction:
+                logger.warning("⚠️ Uncommitted transaction returned to pool - rolling back")
+                conn.rollback()
+            try: _db_pool.put_nowait(conn)
+            except queue.Full: conn.close()
+
+@atexit.register
+def close_db_pool():
+    # Closing the last connection checkpoints the WAL so the next boot doesn't replay it
+    while True:
+        try: conn = _db_pool.get_nowait()
+        except queue.Empty: break
+        try: conn.execute("PRAGMA optimize")
+        except sqlite3.Error: pass
+        conn.close()
+
+# ✅ HOT QUERIES - identical SQL text so every pooled connection reuses its prepared statement
+SQL_USER_BY_EMAIL = "SELECT email,full_name,display_name,password_hash,payment_verified,is_admin FROM users WHERE email=?"
+SQL_ACCESS_BY_EMAIL = "SELECT payment_verified,is_admin FROM users WHERE email=?"
+SQL_IS_ADMIN = "SELECT is_admin FROM users WHERE email=?"
+
+def fetch_value(conn, sql, params=()):
+    """First column of the first row, read through a plain tuple cursor (no Row object)."""
+    cur = conn.cursor(); cur.row_factory = None
+    row = cur.execute(sql, params).fetchone()
+    return row[0] if row else None
+
+def get_user(conn, email):
+    return conn.execute(SQL_USER_BY_EMAIL, (email,)).fetchone()
+
+def is_admin(conn, email):
+    return bool(fetch_value(conn, SQL_IS_ADMIN, (email,)))
+
+# ✅ CHAT EPOCH - bumped every time the chat session is closed; anything cached under an older epoch is stale
+_chat_epoch = None
+_chat_epoch_loaded = 0.0
+
+def get_chat_epoch():
+    global _chat_epoch, _chat_epoch_loaded
+    if _chat_epoch is None or is_stale(_chat_epoch_loaded):
+        with get_db() as conn: _chat_epoch = int(fetch_value(conn, "SELECT setting_value FROM settings WHERE setting_key='chat_epoch'") or 0)
+        _chat_epoch_loaded = time.monotonic()
+    return _chat_epoch
+
+SQL_SET_SETTING = "INSERT INTO settings (setting_key, setting_value) VALUES (?,?) ON CONFLICT(setting_key) DO UPDATE SET setting_value=excluded.setting_value"
+SQL_BUMP_EPOCH = """INSERT INTO settings (setting_key, setting_value) VALUES ('chat_epoch','1')
+    ON CONFLICT(setting_key) DO UPDATE SET setting_value=CAST(setting_value AS INTEGER)+1 RETURNING setting_value"""
+
+def bump_chat_epoch(conn):
+    global _chat_epoch
+    _chat_epoch = int(fetch_value(conn, SQL_BUMP_EPOCH))
+    invalidate_settings()
+    return _chat_epoch
+
+# ✅ ACCESS CACHE - emails known to have paid/admin access, repeat checks skip the database
+ACCESS_CACHE_TTL = 60
+ACCESS_CACHE_MAX = 4096   # LRU bound so every account that ever logged in doesn't stay resident
+_access_cache = OrderedDict()
+
+def has_access(email):
+    """Paid/admin check for the logged-in user. Access is only revoked when the chat epoch moves,
+    so a positive answer is cached (and remembered in the session cookie) for the rest of the epoch.
+    Refusals are never cached - a payment verified on another worker must count immediately."""
+    epoch = get_chat_epoch()
+    if session.get('access_epoch') == epoch: return True
+    hit = _access_cache.get(email)
+    if hit and hit[0] > time.monotonic() and hit[1] == epoch:
+        _access_cache.move_to_end(email)
+        return True
+    with get_db() as conn: u = conn.execute(SQL_ACCESS_BY_EMAIL, (email,)).fetchone()
+    if not (u and (u['payment_verified'] or u['is_admin'])): return False
+    _access_cache[email] = (time.monotonic() + ACCESS_CACHE_TTL, epoch)
+    _access_cache.move_to_end(email)
+    if len(_access_cache) > ACCESS_CACHE_MAX: _access_cache.popitem(last=False)
+    session['access_epoch'] = epoch
+    return True
+
+# ✅ SETTINGS CACHE - the settings table only changes on admin writes and chat close, so reads come from memory
+_settings = None
+_settings_loaded = 0.0
+
+def get_settings():
+    global _settings, _settings_loaded
+    if _settings is None or is_stale(_settings_loaded):
+        with get_db() as conn:
+            _settings = {k: v for k, v in conn.execute("SELECT setting_key, setting_value FROM settings")}
+        _settings_loaded = time.monotonic()
+    return _settings
+
+def invalidate_settings():
+    global _settings
+    _settings = None
+
+# ✅ TIMERS - deadlines are stored as absolute times so every worker and restart agrees
+TIMERS = {'game_timer': ('hours','minutes','seconds'), 'weekly_timer': ('days','hours','minutes','seconds')}
+
+def is_timer_field(key):
+    prefix, _, unit = key.rpartition('_')
+    return unit in TIMERS.get(prefix, ())
+
+def timer_unit(settings, key):
+    """A stored timer unit as an int. Rows saved before update-settings validated them can hold anything - count those as 0."""
+    try: return int(settings.get(key) or 0)
+    except ValueError:
+        logger.warning(f"⚠️ Invalid timer setting {key}={settings.get(key)!r} - treated as 0")
+        return 0
+
+def reset_timer_end(conn, prefix):
+    rows = conn.execute("SELECT setting_key, setting_value FROM settings WHERE setting_key LIKE ?", (prefix + '_%',)).fetchall()
+    s = {r['setting_key']: r['setting_value'] for r in rows}
+    duration = timedelta(**{u: timer_unit(s, f'{prefix}_{u}') for u in TIMERS[prefix]})
+    end = (datetime.now() + duration).isoformat() if duration else ''
+    conn.execute(SQL_SET_SETTING, (f'{prefix}_end', end))
+
+# ✅ PASSWORDS - argon2 runs in eventlet's thread pool (it releases the GIL) so hashing never stalls sockets
+PASSWORD_HASHER = PasswordHasher(time_cost=int(os.environ.get('ARGON2_TIME_COST', 2)),
+                                 memory_cost=int(os.environ.get('ARGON2_MEMORY_KIB', 64 * 1024)), parallelism=2)
+# Each hash holds memory_cost KiB; cap how many run at once instead of letting all 20 tpool threads pile in
+_hash_slots = semaphore.BoundedSemaphore(int(os.environ.get('HASH_CONCURRENCY', 2)))
+
+# Unknown emails are verified against this so they cost the same argon2 run as a real account
+DUMMY_PASSWORD_HASH = PASSWORD_HASHER.hash(secrets.token_hex(16))
+
+def _offload(fn, *args):
+    with _hash_slots: return tpool.execute(fn, *args)
+
 def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+    return _offload(PASSWORD_HASHER.hash, password)
+
+def verify_password(stored, password):
+    """Returns (valid, needs_rehash). Legacy unsalted sha256 hashes are still accepted and flagged for rehash."""
+    if not stored: return False, False
+    if stored.startswith('$argon2'):
+        try: _offload(PASSWORD_HASHER.verify, stored, password)
+        except (VerificationError, InvalidHashError): return False, False
+        return True, PASSWORD_HASHER.check_needs_rehash(stored)
+    return hmac.compare_digest(stored, hashlib.sha256(password.encode()).hexdigest()), True
 
 def sanitize_input(text, max_length=500):
     if not text: return ''
@@ -52,65 +244,88 @@ def safe_get(row, key, default=None):
         return val if val is not None else default
     except: return default
 
+def ensure_column(c, table, column, ddl):
+    """ALTER TABLE ... ADD COLUMN only when an older database is missing it."""
+    if column not in {r['name'] for r in c.execute(f"PRAGMA table_info({table})")}:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+        logger.info(f"🛠️ Added column {table}.{column}")
+
 # ✅ FIRST-TIME SETUP ONLY
+SCHEMA_VERSION = 1   # bump whenever init_db gains a table, column, index or one-time migration
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        full_name TEXT, email TEXT UNIQUE, password_hash TEXT,
-        payment_verified INTEGER DEFAULT 0, is_admin INTEGER DEFAULT 0, display_name TEXT
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS payments (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_email TEXT, bank_name TEXT, reference TEXT,
-        payment_method TEXT DEFAULT 'transfer', status TEXT DEFAULT 'pending'
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        sender_name TEXT, sender_email TEXT, message_text TEXT, is_system INTEGER DEFAULT 0,
-        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS settings (
-        setting_key TEXT PRIMARY KEY, setting_value TEXT
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS claims (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        winner_email TEXT, winner_name TEXT,
-        account_name TEXT, account_number TEXT, bank_name TEXT,
-        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
-    
-    # Create admin ONLY if not exists
-    existing_admin = c.execute("SELECT id FROM users WHERE email='admin@chylnx.com'").fetchone()
-    if not existing_admin:
-        c.execute("INSERT INTO users (full_name, email, password_hash, is_admin, payment_verified) VALUES (?,?,?,?,?)",
-                  ('Admin', 'admin@chylnx.com', hash_password('admin123'), 1, 1))
-        logger.info("👑 Admin created")
-    else:
-        logger.info("👑 Admin already exists - keeping")
-    
-    # ✅ INSERT OR IGNORE - NEVER overwrites existing settings!
-    default_settings = [
-        ('game_timer_hours', '24'), ('game_timer_minutes', '0'), ('game_timer_seconds', '0'),
-        ('weekly_timer_days', '7'), ('weekly_timer_hours', '0'), ('weekly_timer_minutes', '0'), ('weekly_timer_seconds', '0'),
-        ('info_bar_text', 'Welcome to Chylnx Hub! 🌿'), ('info_bar_color', '#667eea'),
-        ('info_bar2_text', '🎮 Join our gaming community!'), ('info_bar2_color', '#f59e0b'),
-        ('info_bar3_text', '💰 Win amazing prizes daily!'), ('info_bar3_color', '#764ba2'),
-    ]
-    for k, v in default_settings:
-        c.execute("INSERT OR IGNORE INTO settings (setting_key, setting_value) VALUES (?,?)", (k, v))
-    
-    conn.commit()
-    conn.close()
-    
-    # Verify settings exist
-    verify = sqlite3.connect(DB_PATH)
-    verify.row_factory = sqlite3.Row
-    count = verify.execute("SELECT COUNT(*) as c FROM settings").fetchone()['c']
-    verify.close()
+    with get_db(commit=True) as conn:
+        c = conn.cursor()
+        # One write transaction for the whole init; workers booting together queue here instead of racing the DDL
+        c.execute("BEGIN IMMEDIATE")
+        
+        # Schema/migrations only run when the file is older than SCHEMA_VERSION - a normal boot skips all DDL
+        if fetch_value(conn, "PRAGMA user_version") < SCHEMA_VERSION:
+            c.execute('''CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                full_name TEXT, email TEXT UNIQUE, password_hash TEXT,
+                payment_verified INTEGER DEFAULT 0, is_admin INTEGER DEFAULT 0, display_name TEXT
+            )''')
+            c.execute('''CREATE TABLE IF NOT EXISTS payments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_email TEXT, bank_name TEXT, reference TEXT,
+                payment_method TEXT DEFAULT 'transfer', status TEXT DEFAULT 'pending',
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''')
+            ensure_column(c, 'payments', 'timestamp', 'TIMESTAMP')
+            c.execute('''CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sender_name TEXT, sender_email TEXT, message_text TEXT, is_system INTEGER DEFAULT 0,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''')
+            c.execute('''CREATE TABLE IF NOT EXISTS settings (
+                setting_key TEXT PRIMARY KEY, setting_value TEXT
+            )''')
+            c.execute('''CREATE TABLE IF NOT EXISTS claims (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                winner_email TEXT, winner_name TEXT,
+                account_name TEXT, account_number TEXT, bank_name TEXT,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''')
+            # Pending payments are listed newest-first; index entries are rowid-ordered so no sort is needed
+            c.execute("CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status)")
+            # One row per transfer reference - retries update it instead of piling up duplicates
+            if not c.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='uniq_payments_reference'").fetchone():
+                # Per reference keep the approved row if there is one, else the newest; NULL references never collide
+                dupes = c.execute("""SELECT id, reference, user_email, status FROM payments p WHERE reference IS NOT NULL
+                    AND id != (SELECT id FROM payments q WHERE q.reference = p.reference ORDER BY status='approved' DESC, id DESC LIMIT 1)""").fetchall()
+                for d in dupes: logger.warning(f"🧹 Removing duplicate payment {d['id']}: ref={d['reference']} user={d['user_email']} status={d['status']}")
+                c.executemany("DELETE FROM payments WHERE id=?", [(d['id'],) for d in dupes])
+                c.execute("CREATE UNIQUE INDEX uniq_payments_reference ON payments(reference)")
+            c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            logger.info(f"🛠️ Schema upgraded to v{SCHEMA_VERSION}")
+        
+        # Create admin ONLY if not exists
+        existing_admin = c.execute("SELECT id FROM users WHERE email='admin@chylnx.com'").fetchone()
+        if not existing_admin:
+            c.execute("INSERT INTO users (full_name, email, password_hash, is_admin, payment_verified) VALUES (?,?,?,?,?)",
+                      ('Admin', 'admin@chylnx.com', hash_password('admin123'), 1, 1))
+            logger.info("👑 Admin created")
+        else:
+            logger.info("👑 Admin already exists - keeping")
+        
+        # ✅ INSERT OR IGNORE - NEVER overwrites existing settings!
+        default_settings = [
+            ('game_timer_hours', '24'), ('game_timer_minutes', '0'), ('game_timer_seconds', '0'),
+            ('weekly_timer_days', '7'), ('weekly_timer_hours', '0'), ('weekly_timer_minutes', '0'), ('weekly_timer_seconds', '0'),
+            ('info_bar_text', 'Welcome to Chylnx Hub! 🌿'), ('info_bar_color', '#667eea'),
+            ('info_bar2_text', '🎮 Join our gaming community!'), ('info_bar2_color', '#f59e0b'),
+            ('info_bar3_text', '💰 Win amazing prizes daily!'), ('info_bar3_color', '#764ba2'),
+        ]
+        c.executemany("INSERT OR IGNORE INTO settings (setting_key, setting_value) VALUES (?,?)", default_settings)
+        for prefix in TIMERS:
+            if not c.execute("SELECT 1 FROM settings WHERE setting_key=?", (f'{prefix}_end',)).fetchone():
+                reset_timer_end(conn, prefix)
+        
+        # Verify settings exist
+        count = fetch_value(conn, "SELECT COUNT(*) FROM settings")
+        # Refreshes planner statistics for tables/indexes that need it (cheap no-op otherwise)
+        c.execute("PRAGMA optimize")
     logger.info(f"✅ Database ready - {count} settings exist")
 
 # Run init
@@ -119,31 +334,85 @@ init_db()
 # ======================
 # HEALTH CHECK
 # ======================
+HEALTH_CACHE_TTL = 5
+_health_cache = [float('-inf'), b'']   # -inf: monotonic() may be under the TTL right after boot
+
 @app.route('/api/health', methods=['GET'])
 def health():
+    # Render polls this constantly - serve the last healthy body for a few seconds
+    if time.monotonic() - _health_cache[0] < HEALTH_CACHE_TTL:
+        return Response(_health_cache[1], mimetype='application/json')
     try:
-        conn = get_db()
-        users = conn.execute("SELECT COUNT(*) as c FROM users").fetchone()['c']
-        settings = conn.execute("SELECT COUNT(*) as c FROM settings").fetchone()['c']
-        sample = conn.execute("SELECT setting_key, setting_value FROM settings LIMIT 3").fetchall()
-        conn.close()
-        return jsonify({
+        with get_db() as conn:
+            users = fetch_value(conn, "SELECT COUNT(*) FROM users")
+            settings = fetch_value(conn, "SELECT COUNT(*) FROM settings")
+            sample = conn.execute("SELECT setting_key, setting_value FROM settings LIMIT 3").fetchall()
+        body = orjson.dumps({
             'status': 'ok', 'db_path': DB_PATH, 'db_exists': os.path.exists(DB_PATH),
             'users': users, 'settings': settings,
             'sample': [dict(s) for s in sample]
         })
+        _health_cache[:] = [time.monotonic(), body]
+        return Response(body, mimetype='application/json')
     except Exception as e:
         return jsonify({'status': 'error', 'error': str(e)}), 500
 
+# ======================
+# CACHE HEADERS - public pages may be cached, anything behind login/payment must not
+# ======================
+PUBLIC_PAGES = {'index.html', 'login.html', 'payment.html'}
+PRIVATE_PAGES = {'chat.html', 'admin.html', 'admin_dashboard.html'}
+
+@app.after_request
+def cache_headers(resp):
+    page = request.path.lstrip('/') or 'index.html'
+    if request.path.startswith('/api/') or page in PRIVATE_PAGES:
+        resp.headers['Cache-Control'] = 'no-store, private'
+        resp.vary.add('Cookie')
+    elif resp.status_code == 200 and page in PUBLIC_PAGES:
+        resp.headers['Cache-Control'] = 'public, max-age=300'
+    return resp
+
 # ======================
 # ROUTES (unchanged)
 # ======================
+# ✅ PAGE CACHE - the HTML pages are static files; read, hash and gzip each once, then answer from memory
+_page_cache = {}
+
+def load_page(name):
+    page = _page_cache.get(name)
+    if page is None:
+        path = os.path.join(app.root_path, name)
+        with open(path, 'rb') as f: body = f.read()
+        page = _page_cache[name] = (body, gzip.compress(body), hashlib.md5(body).hexdigest(),
+                                    datetime.utcfromtimestamp(int(os.path.getmtime(path))))
+    return page
+
+def serve_page(name):
+    body, gz_body, etag, modified = load_page(name)
+    # Sent already encoded so Flask-Compress passes it through untouched - it would otherwise rewrite the
+    # ETag to "<hash>:gzip" after make_conditional ran, and the browser's If-None-Match would never match
+    if request.accept_encodings.quality('gzip'):
+        resp = Response(gz_body, mimetype='text/html')
+        resp.headers['Content-Encoding'] = 'gzip'
+        resp.set_etag(etag + ':gzip')
+    else:
+        resp = Response(body, mimetype='text/html')
+        resp.set_etag(etag)
+    resp.vary.add('Accept-Encoding')
+    resp.last_modified = modified
+    return resp.make_conditional(request)
+
+# Every page is served from this cache - read and gzip them all at boot, not on each worker's first hit
+for _name in PUBLIC_PAGES | PRIVATE_PAGES: load_page(_name)
+
 @app.route('/')
-def index(): return send_from_directory('.', 'index.html')
+def index(): return serve_page('index.html')
 
 @app.route('/<path:filename>')
 def serve(filename):
     if '..' in filename: return jsonify({'error':'Invalid'}), 400
+    if filename in PUBLIC_PAGES or filename in PRIVATE_PAGES: return serve_page(filename)
     return send_from_directory('.', filename)
 
 @app.route('/api/auth/register', methods=['POST'])
@@ -155,11 +424,12 @@ def register():
     pwd = safe_get(data,'password','')
     if not name or not email or not pwd: return jsonify({'error':'All fields required'}), 400
     if len(pwd) < 6: return jsonify({'error':'Password too short'}), 400
-    conn = get_db()
-    if conn.execute("SELECT id FROM users WHERE email=?",(email,)).fetchone():
-        conn.close(); return jsonify({'error':'Email already registered'}), 409
-    conn.execute("INSERT INTO users (full_name,email,password_hash) VALUES (?,?,?)",(name,email,hash_password(pwd)))
-    conn.commit(); conn.close()
+    pwd_hash = hash_password(pwd)
+    try:
+        with get_db(commit=True) as conn:
+            conn.execute("INSERT INTO users (full_name,email,password_hash) VALUES (?,?,?)",(name,email,pwd_hash))
+    except sqlite3.IntegrityError:
+        return jsonify({'error':'Email already registered'}), 409
     # ✅ Log current settings to verify they weren't changed
     logger.info(f"✅ New user: {email} - Settings preserved")
     return jsonify({'success':True,'message':'Account created!'}), 201
@@ -171,11 +441,16 @@ def login():
     email = safe_get(data,'email','').lower().strip()
     pwd = safe_get(data,'password','')
     if not email or not pwd: return jsonify({'error':'Email and password required'}), 400
-    conn = get_db()
-    user = conn.execute("SELECT * FROM users WHERE email=?",(email,)).fetchone()
-    if not user or user['password_hash'] != hash_password(pwd):
-        conn.close(); return jsonify({'error':'Invalid credentials'}), 401
-    conn.close()
+    with get_db() as conn:
+        user = get_user(conn, email)
+    valid, needs_rehash = verify_password((user and user['password_hash']) or DUMMY_PASSWORD_HASH, pwd)
+    if not (user and valid):
+        return jsonify({'error':'Invalid credentials'}), 401
+    if needs_rehash:
+        # Hash first - a pooled connection must not sit idle through the argon2 run
+        new_hash = hash_password(pwd)
+        with get_db(commit=True) as conn:
+            conn.execute("UPDATE users SET password_hash=? WHERE email=?",(new_hash,email))
     session.clear()
     session['user_email'] = user['email']
     session.permanent = True
@@ -190,9 +465,8 @@ def login():
 def me():
     email = session.get('user_email')
     if not email: return jsonify({'error':'Not logged in'}), 401
-    conn = get_db()
-    user = conn.execute("SELECT * FROM users WHERE email=?",(email,)).fetchone()
-    conn.close()
+    with get_db() as conn:
+        user = get_user(conn, email)
     if not user: return jsonify({'error':'Not found'}), 404
     return jsonify({
         'email':user['email'],'fullName':user['full_name'],
@@ -205,19 +479,13 @@ def logout(): session.clear(); return jsonify({'success':True})
 
 @app.route('/api/settings', methods=['GET'])
 def settings():
-    conn = get_db()
-    rows = conn.execute("SELECT * FROM settings").fetchall()
-    conn.close()
-    return jsonify({'settings':{r['setting_key']:r['setting_value'] for r in rows}})
+    return jsonify({'settings': get_settings()})
 
 @app.route('/api/check-access', methods=['GET'])
 def check_access():
     email = session.get('user_email')
     if not email: return jsonify({'hasAccess':False}), 401
-    conn = get_db()
-    u = conn.execute("SELECT payment_verified,is_admin FROM users WHERE email=?",(email,)).fetchone()
-    conn.close()
-    return jsonify({'hasAccess':bool(u['payment_verified'] or u['is_admin']) if u else False})
+    return jsonify({'hasAccess':has_access(email)})
 
 @app.route('/api/set-display-name', methods=['POST'])
 def set_name():
@@ -226,9 +494,8 @@ def set_name():
     data = request.get_json(silent=True)
     name = safe_get(data,'displayName','').strip()
     if len(name)<2: return jsonify({'error':'Too short'}), 400
-    conn = get_db()
-    conn.execute("UPDATE users SET display_name=? WHERE email=?",(name,email))
-    conn.commit(); conn.close()
+    with get_db(commit=True) as conn:
+        conn.execute("UPDATE users SET display_name=? WHERE email=?",(name,email))
     return jsonify({'success':True})
 
 @app.route('/api/submit-payment', methods=['POST'])
@@ -240,31 +507,32 @@ def submit_payment():
     ref = safe_get(data,'reference','').strip()
     method = safe_get(data,'method','transfer')
     if not bank or not ref: return jsonify({'error':'Bank and reference required'}), 400
-    conn = get_db()
-    conn.execute("INSERT INTO payments (user_email,bank_name,reference,payment_method) VALUES (?,?,?,?)",(email,bank,ref,method))
-    conn.commit(); conn.close()
+    with get_db(commit=True) as conn:
+        cur = conn.execute("""INSERT INTO payments (user_email,bank_name,reference,payment_method,timestamp) VALUES (?,?,?,?,CURRENT_TIMESTAMP)
+            ON CONFLICT(reference) DO UPDATE SET bank_name=excluded.bank_name, payment_method=excluded.payment_method
+            WHERE payments.user_email=excluded.user_email AND payments.status='pending'""",(email,bank,ref,method))
+        if not cur.rowcount and fetch_value(conn, "SELECT user_email FROM payments WHERE reference=?",(ref,)) != email:
+            logger.warning(f"⚠️ Payment reference reuse: {ref} by {email}")
+            return jsonify({'error':'Reference already used'}), 409
     return jsonify({'success':True})
 
 @app.route('/api/admin/pending-payments')
 def admin_payments():
     email = session.get('user_email')
     if not email: return jsonify({'error':'Login'}), 401
-    conn = get_db()
-    admin = conn.execute("SELECT is_admin FROM users WHERE email=?",(email,)).fetchone()
-    if not admin or not admin['is_admin']: conn.close(); return jsonify({'error':'Admin only'}), 403
-    payments = conn.execute("SELECT p.*,u.full_name FROM payments p JOIN users u ON p.user_email=u.email WHERE p.status='pending' ORDER BY p.rowid DESC").fetchall()
-    conn.close()
+    with get_db() as conn:
+        if not is_admin(conn, email): return jsonify({'error':'Admin only'}), 403
+        payments = conn.execute("SELECT p.id,p.user_email,p.bank_name,p.reference,p.payment_method,p.status,p.timestamp,u.full_name FROM payments p JOIN users u ON p.user_email=u.email WHERE p.status='pending' ORDER BY p.rowid DESC").fetchall()
     return jsonify({'payments':[dict(p) for p in payments]})
 
 @app.route('/api/admin/users')
 def admin_users():
     email = session.get('user_email')
     if not email: return jsonify({'error':'Login'}), 401
-    conn = get_db()
-    admin = conn.execute("SELECT is_admin FROM users WHERE email=?",(email,)).fetchone()
-    if not admin or not admin['is_admin']: conn.close(); return jsonify({'error':'Admin only'}), 403
-    users = conn.execute("SELECT email,full_name,payment_verified,display_name FROM users WHERE is_admin=0 ORDER BY rowid DESC").fetchall()
-    conn.close()
+    limit = request.args.get('limit', -1, type=int); offset = request.args.get('offset', 0, type=int)
+    with get_db() as conn:
+        if not is_admin(conn, email): return jsonify({'error':'Admin only'}), 403
+        users = conn.execute("SELECT email,full_name,payment_verified,display_name FROM users WHERE is_admin=0 ORDER BY rowid DESC LIMIT ? OFFSET ?",(limit,offset)).fetchall()
     return jsonify({'users':[dict(u) for u in users]})
 
 @app.route('/api/admin/verify', methods=['POST'])
@@ -273,14 +541,11 @@ def admin_verify():
     if not email: return jsonify({'error':'Login'}), 401
     data = request.get_json(silent=True)
     pid = safe_get(data,'paymentId')
-    conn = get_db()
-    admin = conn.execute("SELECT is_admin FROM users WHERE email=?",(email,)).fetchone()
-    if not admin or not admin['is_admin']: conn.close(); return jsonify({'error':'Admin only'}), 403
-    p = conn.execute("SELECT user_email FROM payments WHERE id=? AND status='pending'",(pid,)).fetchone()
-    if not p: conn.close(); return jsonify({'error':'Not found'}), 404
-    conn.execute("UPDATE payments SET status='approved' WHERE id=?",(pid,))
-    conn.execute("UPDATE users SET payment_verified=1 WHERE email=?",(p['user_email'],))
-    conn.commit(); conn.close()
+    with get_db(commit=True) as conn:
+        if not is_admin(conn, email): return jsonify({'error':'Admin only'}), 403
+        p = conn.execute("UPDATE payments SET status='approved' WHERE id=? AND status='pending' RETURNING user_email",(pid,)).fetchone()
+        if not p: return jsonify({'error':'Not found'}), 404
+        conn.execute("UPDATE users SET payment_verified=1 WHERE email=?",(p['user_email'],))
     return jsonify({'success':True})
 
 @app.route('/api/admin/verify-user-payment', methods=['POST'])
@@ -289,11 +554,9 @@ def admin_verify_user():
     if not email: return jsonify({'error':'Login'}), 401
     data = request.get_json(silent=True)
     target = safe_get(data,'email','').lower().strip()
-    conn = get_db()
-    admin = conn.execute("SELECT is_admin FROM users WHERE email=?",(email,)).fetchone()
-    if not admin or not admin['is_admin']: conn.close(); return jsonify({'error':'Admin only'}), 403
-    conn.execute("UPDATE users SET payment_verified=1 WHERE email=?",(target,))
-    conn.commit(); conn.close()
+    with get_db(commit=True) as conn:
+        if not is_admin(conn, email): return jsonify({'error':'Admin only'}), 403
+        conn.execute("UPDATE users SET payment_verified=1 WHERE email=?",(target,))
     return jsonify({'success':True})
 
 @app.route('/api/admin/update-settings', methods=['POST'])
@@ -301,38 +564,38 @@ def admin_settings():
     email = session.get('user_email')
     if not email: return jsonify({'error':'Login'}), 401
     data = request.get_json(silent=True)
-    k = safe_get(data,'key'); v = safe_get(data,'value')
-    if not k: return jsonify({'error':'Key required'}), 400
-    conn = get_db()
-    admin = conn.execute("SELECT is_admin FROM users WHERE email=?",(email,)).fetchone()
-    if not admin or not admin['is_admin']: conn.close(); return jsonify({'error':'Admin only'}), 403
-    conn.execute("INSERT OR REPLACE INTO settings (setting_key, setting_value) VALUES (?,?)", (k, str(v)))
-    conn.commit(); conn.close()
-    logger.info(f"⚙️ Setting updated: {k} = {v}")
+    # Either {'key','value'} or {'settings': {key: value, ...}} to apply a whole group in one transaction
+    updates = safe_get(data,'settings') or {safe_get(data,'key'): safe_get(data,'value')}
+    if not isinstance(updates, dict) or not all(updates): return jsonify({'error':'Key required'}), 400
+    with get_db(commit=True) as conn:
+        if not is_admin(conn, email): return jsonify({'error':'Admin only'}), 403
+        bad = [k for k, v in updates.items() if is_timer_field(k) and not str(v).strip().isdecimal()]
+        if bad: return jsonify({'error':f"Timer values must be whole numbers: {', '.join(bad)}"}), 400
+        conn.executemany(SQL_SET_SETTING, [(k, str(v)) for k, v in updates.items()])
+        for prefix in {k.rsplit('_', 1)[0] for k in updates if not k.endswith('_end')} & TIMERS.keys():
+            reset_timer_end(conn, prefix)
+    invalidate_settings()
+    logger.info(f"⚙️ Settings updated: {updates}")
     return jsonify({'success':True})
 
 @app.route('/api/timers', methods=['GET'])
 def get_timers():
-    conn = get_db()
-    rows = conn.execute("SELECT setting_key, setting_value FROM settings WHERE setting_key LIKE '%timer%'").fetchall()
-    settings = {r['setting_key']: r['setting_value'] for r in rows}
-    conn.close()
-    gh = int(settings.get('game_timer_hours', 0))
-    gm = int(settings.get('game_timer_minutes', 0))
-    gs = int(settings.get('game_timer_seconds', 0))
-    wd = int(settings.get('weekly_timer_days', 0))
-    wh = int(settings.get('weekly_timer_hours', 0))
-    wm = int(settings.get('weekly_timer_minutes', 0))
-    ws = int(settings.get('weekly_timer_seconds', 0))
-    now = datetime.now()
+    settings = get_settings()
+    gh = timer_unit(settings, 'game_timer_hours')
+    gm = timer_unit(settings, 'game_timer_minutes')
+    gs = timer_unit(settings, 'game_timer_seconds')
+    wd = timer_unit(settings, 'weekly_timer_days')
+    wh = timer_unit(settings, 'weekly_timer_hours')
+    wm = timer_unit(settings, 'weekly_timer_minutes')
+    ws = timer_unit(settings, 'weekly_timer_seconds')
     return jsonify({
         'game_timer': {
             'hours': gh, 'minutes': gm, 'seconds': gs,
-            'end_time': (now + timedelta(hours=gh, minutes=gm, seconds=gs)).isoformat() if (gh or gm or gs) else None
+            'end_time': settings.get('game_timer_end') or None
         },
         'weekly_timer': {
             'days': wd, 'hours': wh, 'minutes': wm, 'seconds': ws,
-            'end_time': (now + timedelta(days=wd, hours=wh, minutes=wm, seconds=ws)).isoformat() if (wd or wh or wm or ws) else None
+            'end_time': settings.get('weekly_timer_end') or None
         }
     })
 
@@ -340,44 +603,190 @@ def get_timers():
 def get_online_users():
     email = session.get('user_email')
     if not email: return jsonify({'error':'Login'}), 401
-    conn = get_db()
-    admin = conn.execute("SELECT is_admin FROM users WHERE email=?",(email,)).fetchone()
-    if not admin or not admin['is_admin']: conn.close(); return jsonify({'error':'Admin only'}), 403
+    with get_db() as conn:
+        if not is_admin(conn, email): return jsonify({'error':'Admin only'}), 403
     online_list = [{'email': e, 'name': d.get('name', 'Unknown')} for e, d in online_users.items() if e != email]
-    conn.close()
     return jsonify({'online_users': online_list, 'count': len(online_list)})
 
+# ======================
+# MESSAGE WRITER - buffers chat inserts and commits them in one transaction per tick
+# ======================
+MESSAGE_FLUSH_INTERVAL = 0.05
+MESSAGE_BATCH_MAX = 500
+MESSAGE_FLUSH_EARLY = 256   # a backlog this deep is flushed without waiting out the interval
+MESSAGE_QUEUE_MAX = 10_000  # past this the database is not keeping up - new messages are refused, not buffered
+MESSAGE_RETRY_MAX = 5.0     # longest wait between retries while writes keep failing
+SQL_INSERT_MESSAGE = "INSERT INTO messages (sender_name,sender_email,message_text,is_system,timestamp) VALUES (?,?,?,?,?)"
+_pending_messages = deque()
+_writer_started = False
+_queue_full = False
+_writer_wake = threading.Event()   # green under monkey_patch
+BROADCAST_WINDOW = 0.02
+_pending_broadcast = []
+
+def utc_timestamp():
+    """UTC 'YYYY-MM-DD HH:MM:SS' - the same text SQLite's CURRENT_TIMESTAMP stores, so live and history messages agree."""
+    return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+def queue_message(sender, sender_email, text, is_system, payload=None):
+    """Queue a message row for the writer; if payload is given it is broadcast to main_chat right away,
+    so recipients never wait on the database. Returns False (nothing sent) when the queue is full."""
+    global _writer_started, _queue_full
+    if len(_pending_messages) >= MESSAGE_QUEUE_MAX:
+        if not _queue_full:
+            _queue_full = True
+            logger.warning(f"⚠️ Message queue full ({MESSAGE_QUEUE_MAX}) - refusing new messages until the writer catches up")
+        return False
+    _queue_full = False
+    ts = utc_timestamp()
+    row = (sender, sender_email, text, is_system, ts)
+    _pending_messages.append(row)
+    if payload is not None:
+        payload['timestamp'] = ts
+        queue_broadcast(payload, row)
+    else: remember_message(row)
+    if len(_pending_messages) >= MESSAGE_FLUSH_EARLY: _writer_wake.set()
+    if not _writer_started:
+        _writer_started = True
+        socketio.start_background_task(_message_writer)
+    return True
+
+def queue_broadcast(payload, row):
+    """Collect chat broadcasts for BROADCAST_WINDOW and send them as one frame per client."""
+    _pending_broadcast.append((payload, row))
+    if len(_pending_broadcast) == 1: socketio.start_background_task(_flush_broadcast)
+
+def _flush_broadcast():
+    socketio.sleep(BROADCAST_WINDOW)
+    batch = [p for p, _ in _pending_broadcast]
+    # Into the history in the same step as the emit: a join sees each message exactly once, live or in chat_history
+    for _, row in _pending_broadcast: remember_message(row)
+    _pending_broadcast.clear()
+    if len(batch) == 1: socketio.emit('new_message', batch[0], room='main_chat')
+    elif batch: socketio.emit('messages', batch, room='main_chat')
+
+def flush_messages():
+    """Drain the queue in transactions of at most MESSAGE_BATCH_MAX rows, yielding to other greenlets between them."""
+    while _pending_messages:
+        batch = [_pending_messages.popleft() for _ in range(min(len(_pending_messages), MESSAGE_BATCH_MAX))]
+        try: _flush_batch(batch)
+        except Exception:
+            # These were already broadcast - put them back in order so the next flush retries them
+            _pending_messages.extendleft(reversed(batch))
+            logger.warning(f"⚠️ Message write failed - {len(batch)} messages re-queued")
+            raise
+        if _pending_messages: socketio.sleep(0)
+
+def _flush_batch(batch):
+    with get_db(commit=True) as conn:
+        conn.executemany(SQL_INSERT_MESSAGE, batch)
+
+# ======================
+# HISTORY CACHE - last messages kept in memory so joins don't re-query
+# ======================
+CHAT_HISTORY_LIMIT = int(os.environ.get('CHAT_HISTORY_LIMIT', 50))
+_history = None
+_history_loaded = 0.0
+_history_payload = None
+
+def format_message(m):
+    return {'id':m['id'],'sender':m['sender_name'],'text':m['message_text'],'timestamp':m['timestamp'] or utc_timestamp(),'isSystem':bool(m['is_system']),'senderEmail':m['sender_email'] or ''}
+
+def format_row(row):
+    """History entry for a queued (sender, email, text, is_system, ts) row - no id until the writer commits it."""
+    return {'sender':row[0],'text':row[2],'timestamp':row[4],'isSystem':bool(row[3]),'senderEmail':row[1] or ''}
+
+def remember_message(row):
+    """Add a message to the history cache once clients can see it, without waiting for the writer."""
+    global _history_payload
+    if _history is None: return
+    _history.append(format_row(row))
+    _history_payload = None
+
+def get_history():
+    """chat_history payload. Encoded once per history change (orjson.Fragment) and sent verbatim to every join."""
+    global _history, _history_loaded, _history_payload
+    if _history is None or is_stale(_history_loaded):
+        _history_loaded = time.monotonic()
+        with get_db() as conn:
+            msgs = conn.execute("SELECT * FROM (SELECT id,sender_name,sender_email,message_text,is_system,timestamp FROM messages ORDER BY id DESC LIMIT ?) ORDER BY id", (CHAT_HISTORY_LIMIT,))
+            _history = deque((format_message(m) for m in msgs), maxlen=CHAT_HISTORY_LIMIT)
+        # Queued rows aren't in the table yet; add those already sent live, not the ones still in the broadcast window
+        unsent = {id(row) for _, row in _pending_broadcast}
+        _history.extend(format_row(row) for row in _pending_messages if id(row) not in unsent)
+        _history_payload = None
+    if _history_payload is None:
+        _history_payload = orjson.Fragment(orjson.dumps({'messages': list(_history)}))
+    return _history_payload
+
+def emit_local(event, data, sid=None):
+    """Reply to one client. Its socket lives on this worker, so skip the Redis round trip."""
+    socketio.emit(event, data, to=sid or request.sid, ignore_queue=True)
+
+def history_is_warm():
+    return _history is not None and not is_stale(_history_loaded)
+
+def _send_history(sid):
+    try: emit_local('chat_history', get_history(), sid)
+    except Exception as e: logger.error(f"❌ History load failed: {e}")
+
+def _message_writer():
+    delay = MESSAGE_FLUSH_INTERVAL
+    while True:
+        # While backing off, a deep backlog must not wake the writer early into the same failure
+        if delay > MESSAGE_FLUSH_INTERVAL: socketio.sleep(delay)
+        else: _writer_wake.wait(delay)
+        _writer_wake.clear()
+        try: flush_messages()
+        except Exception as e:
+            # Full traceback once per failure streak, then a one-line reminder per retry
+            if delay == MESSAGE_FLUSH_INTERVAL: logger.exception("❌ Message flush failed")
+            else: logger.warning(f"⚠️ Message flush still failing ({len(_pending_messages)} queued): {e}")
+            delay = min(delay * 2, MESSAGE_RETRY_MAX)
+        else: delay = MESSAGE_FLUSH_INTERVAL
+
+@atexit.register
+def flush_on_exit():
+    # Chat still waiting on the writer's next tick would otherwise be lost on every deploy/restart.
+    # Registered after close_db_pool, so atexit (last in, first out) runs it while the pool is still open
+    try: flush_messages()
+    except Exception: logger.exception(f"❌ Shutdown flush failed - {len(_pending_messages)} messages lost")
+
 # Socket.IO events (unchanged)
 online_users = {}
+sid_to_email = {}   # reverse index so disconnects don't scan online_users
 
 @socketio.on('connect')
-def on_connect(): logger.info(f"🟢 Connected: {request.sid}")
+def on_connect(): logger.debug("🟢 Connected: %s", request.sid)
 
 @socketio.on('disconnect')
 def on_disconnect():
-    to_remove = None
-    for email, data in online_users.items():
-        if data['sid'] == request.sid: to_remove = email; break
-    if to_remove:
+    to_remove = sid_to_email.pop(request.sid, None)
+    info = online_users.get(to_remove)
+    if info is None: return
+    # A user with several tabs stays online until the last of their sockets is gone
+    info['sids'].discard(request.sid)
+    if not info['sids']:
         del online_users[to_remove]
+        logger.debug("🔴 Left chat: %s (%d online)", to_remove, len(online_users))
         socketio.emit('online_count', {'count': len(online_users)}, room='main_chat')
 
 @socketio.on('join_chat')
 def on_join():
     email = session.get('user_email')
     if not email: return
-    conn = get_db()
-    user = conn.execute("SELECT * FROM users WHERE email=?",(email,)).fetchone()
-    conn.close()
-    if not user or (not user['payment_verified'] and not user['is_admin']): emit('error', {'message': 'Access denied'}); return
+    with get_db() as conn:
+        user = get_user(conn, email)
+    if not user or (not user['payment_verified'] and not user['is_admin']): emit_local('error', {'message': 'Access denied'}); return
     name = safe_get(user,'display_name') or user['full_name'].split()[0]
-    online_users[email] = {'sid': request.sid, 'name': name}
+    sid_to_email[request.sid] = email
+    info = online_users.setdefault(email, {'sids': set()})
+    info.update(name=name, is_admin=bool(user['is_admin'])); info['sids'].add(request.sid)
     join_room('main_chat')
-    conn = get_db()
-    msgs = conn.execute("SELECT * FROM messages ORDER BY rowid DESC LIMIT 50").fetchall()
-    conn.close()
-    formatted = [{'id':m['id'],'sender':m['sender_name'],'text':m['message_text'],'timestamp':m['timestamp'] if m['timestamp'] else datetime.now().isoformat(),'isSystem':bool(m['is_system']),'senderEmail':m['sender_email'] or ''} for m in reversed(msgs)]
-    emit('chat_history', {'messages': formatted})
+    if user['is_admin']: join_room('admins')
+    # Warm cache: answer inline. Cold cache: let the join finish and load history off the handler
+    if history_is_warm(): emit_local('chat_history', get_history())
+    else: socketio.start_background_task(_send_history, request.sid)
     socketio.emit('online_count', {'count': len(online_users)}, room='main_chat')
 
 @socketio.on('send_message')
@@ -386,45 +795,35 @@ def on_message(data):
     if not email: return
     text = safe_get(data, 'text', '').strip()
     if not text: return
-    conn = get_db()
-    user = conn.execute("SELECT * FROM users WHERE email=?",(email,)).fetchone()
-    if not user or (not user['payment_verified'] and not user['is_admin']): conn.close(); return
-    name = safe_get(user,'display_name') or user['full_name'].split()[0]
-    if user['is_admin']: name = f'👑 {name}'
-    conn.execute("INSERT INTO messages (sender_name,sender_email,message_text,is_system,timestamp) VALUES (?,?,?,?,CURRENT_TIMESTAMP)",(name,email,text,0))
-    conn.commit()
-    msg = conn.execute("SELECT * FROM messages WHERE rowid=last_insert_rowid()").fetchone()
-    conn.close()
-    emit('new_message', {'id':msg['id'],'sender':name,'text':text,'timestamp':msg['timestamp'] if msg['timestamp'] else datetime.now().isoformat(),'isSystem':False,'senderEmail':email}, room='main_chat')
+    info = online_users.get(email)
+    if not info or not has_access(email): return
+    name = f"👑 {info['name']}" if info['is_admin'] else info['name']
+    if not queue_message(name, email, text, 0, {'sender':name,'text':text,'isSystem':False,'senderEmail':email}):
+        emit_local('error', {'message': 'Chat is busy - message not sent, please try again'})
 
 @socketio.on('admin_broadcast')
 def on_broadcast(data):
     email = session.get('user_email')
     if not email: return
-    conn = get_db()
-    user = conn.execute("SELECT * FROM users WHERE email=?",(email,)).fetchone()
-    if not user or not user['is_admin']: conn.close(); return
+    with get_db() as conn:
+        user = get_user(conn, email)
+    if not user or not user['is_admin']: return
     msg_text = safe_get(data,'message','').strip()
-    if not msg_text: conn.close(); return
+    if not msg_text: return
     name = safe_get(user,'display_name') or 'Admin'
     txt = f'🔊 {name}: {msg_text}'
-    conn.execute("INSERT INTO messages (sender_name,sender_email,message_text,is_system,timestamp) VALUES (?,?,?,?,CURRENT_TIMESTAMP)",('📢 ANNOUNCEMENT',email,txt,1))
-    conn.commit(); conn.close()
-    emit('new_message', {'id':0,'sender':'📢 ANNOUNCEMENT','text':txt,'timestamp':datetime.now().isoformat(),'isSystem':True,'senderEmail':email}, room='main_chat')
+    queue_message('📢 ANNOUNCEMENT', email, txt, 1, {'sender':'📢 ANNOUNCEMENT','text':txt,'isSystem':True,'senderEmail':email})
 
 @socketio.on('declare_winner')
 def on_declare_winner(data):
     email = session.get('user_email')
     if not email: return
-    conn = get_db()
-    admin = conn.execute("SELECT is_admin FROM users WHERE email=?",(email,)).fetchone()
-    if not admin or not admin['is_admin']: conn.close(); return
+    with get_db() as conn:
+        if not is_admin(conn, email): return
     winner_name = safe_get(data, 'name', 'Winner'); winner_email = safe_get(data, 'email', '')
     win_msg = f'🏆🎉 {winner_name} is the WINNER! 🎉🏆'
-    conn.execute("INSERT INTO messages (sender_name,sender_email,message_text,is_system,timestamp) VALUES (?,?,?,?,CURRENT_TIMESTAMP)",('🏆 SYSTEM', email, win_msg, 1))
-    conn.commit(); conn.close()
     emit('winner_announced', {'winner_email': winner_email, 'winner_name': winner_name}, room='main_chat')
-    emit('new_message', {'id':0,'sender':'🏆 SYSTEM','text':win_msg,'timestamp':datetime.now().isoformat(),'isSystem':True,'senderEmail':email}, room='main_chat')
+    queue_message('🏆 SYSTEM', email, win_msg, 1, {'sender':'🏆 SYSTEM','text':win_msg,'isSystem':True,'senderEmail':email})
 
 @socketio.on('submit_claim')
 def on_submit_claim(data):
@@ -433,33 +832,31 @@ def on_submit_claim(data):
     account_name = safe_get(data, 'accountName', ''); account_number = safe_get(data, 'accountNumber', '')
     bank_name = safe_get(data, 'bankName', ''); winner_name = safe_get(data, 'winnerName', '')
     winner_email = safe_get(data, 'winnerEmail', email)
-    conn = get_db()
-    conn.execute("INSERT INTO claims (winner_email, winner_name, account_name, account_number, bank_name) VALUES (?,?,?,?,?)",(winner_email, winner_name, account_name, account_number, bank_name))
-    conn.commit(); conn.close()
     claim_msg = f'💰 CLAIM: {winner_name} | Bank: {bank_name} | Acct: {account_number} | Name: {account_name}'
-    conn = get_db()
-    conn.execute("INSERT INTO messages (sender_name,sender_email,message_text,is_system,timestamp) VALUES (?,?,?,?,CURRENT_TIMESTAMP)",('💰 CLAIM SYSTEM', winner_email, claim_msg, 1))
-    conn.commit(); conn.close()
-    emit('claim_response', {'success': True})
-    for admin_email, admin_data in online_users.items():
-        conn = get_db(); admin_check = conn.execute("SELECT is_admin FROM users WHERE email=?",(admin_email,)).fetchone(); conn.close()
-        if admin_check and admin_check['is_admin']:
-            socketio.emit('new_message', {'id':0,'sender':'💰 CLAIM SYSTEM','text':claim_msg,'timestamp':datetime.now().isoformat(),'isSystem':True,'senderEmail':winner_email}, room=admin_data['sid'])
+    with get_db(commit=True) as conn:
+        conn.execute("INSERT INTO claims (winner_email, winner_name, account_name, account_number, bank_name) VALUES (?,?,?,?,?)",(winner_email, winner_name, account_name, account_number, bank_name))
+    queue_message('💰 CLAIM SYSTEM', winner_email, claim_msg, 1)
+    emit_local('claim_response', {'success': True})
+    socketio.emit('new_message', {'id':0,'sender':'💰 CLAIM SYSTEM','text':claim_msg,'timestamp':utc_timestamp(),'isSystem':True,'senderEmail':winner_email}, room='admins')
 
 @socketio.on('close_chat_session')
 def on_close_chat():
+    global _history
     email = session.get('user_email')
     if not email: return
-    conn = get_db()
-    admin = conn.execute("SELECT is_admin FROM users WHERE email=?",(email,)).fetchone()
-    if not admin or not admin['is_admin']: conn.close(); return
-    conn.execute("DELETE FROM messages")
-    conn.execute("UPDATE users SET payment_verified = 0 WHERE is_admin = 0")
-    conn.execute("DELETE FROM claims"); conn.execute("DELETE FROM payments")
-    close_msg = '🔒 Chat session closed! All messages cleared. Payment required to re-enter.'
-    conn.execute("INSERT INTO messages (sender_name,sender_email,message_text,is_system,timestamp) VALUES (?,?,?,?,CURRENT_TIMESTAMP)",('🔒 SYSTEM', email, close_msg, 1))
-    conn.commit(); conn.close()
-    emit('chat_closed', {'message': '🏆 All winners have been rewarded!\n🔒 Chat session is now closed.\n💳 Payment required to re-enter.\n\nRedirecting to homepage...'}, room='main_chat')
+    with get_db() as conn:
+        if not is_admin(conn, email): return
+    flush_messages()
+    with get_db(commit=True) as conn:
+        conn.execute("DELETE FROM messages")
+        conn.execute("UPDATE users SET payment_verified = 0 WHERE is_admin = 0 AND payment_verified != 0")
+        conn.execute("DELETE FROM claims"); conn.execute("DELETE FROM payments")
+        close_msg = '🔒 Chat session closed! All messages cleared. Payment required to re-enter.'
+        conn.execute("INSERT INTO messages (sender_name,sender_email,message_text,is_system,timestamp) VALUES (?,?,?,?,CURRENT_TIMESTAMP)",('🔒 SYSTEM', email, close_msg, 1))
+        epoch = bump_chat_epoch(conn)
+    _history = None
+    logger.info(f"🔒 Chat session closed by {email} - epoch {epoch}")
+    emit('chat_closed', {'message': '🏆 All winners have been rewarded!\n🔒 Chat session is now closed.\n💳 Payment required to re-enter.\n\nRedirecting to homepage...', 'epoch': epoch}, room='main_chat')
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 10000))
@@ -468,4 +865,4 @@ if __name__ == '__main__':
     logger.info("👑 Admin: admin@chylnx.com / admin123")
     logger.info(f"📁 Database: {DB_PATH}")
     logger.info("=" * 50)
-    socketio.run(app, host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+    socketio.run(app, host='0.0.0.0', port=port, debug=True)
@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# app.py creates its database on import - keep it out of the working tree
+os.environ.setdefault('RENDER_DISK_PATH', tempfile.mkdtemp())
@@ -0,0 +1,19 @@
+from app import app
+
+GZIP = {'Accept-Encoding': 'gzip, deflate, br'}
+
+
+def test_chat_page_revalidates_by_etag_when_compressed():
+    client = app.test_client()
+    first = client.get('/chat.html', headers=GZIP)
+    assert first.status_code == 200
+    assert first.headers['Content-Encoding'] == 'gzip'
+    again = client.get('/chat.html', headers={**GZIP, 'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+
+
+def test_chat_page_revalidates_by_last_modified_when_compressed():
+    client = app.test_client()
+    first = client.get('/chat.html', headers=GZIP)
+    again = client.get('/chat.html', headers={**GZIP, 'If-Modified-Since': first.headers['Last-Modified']})
+    assert again.status_code == 304
@@ -0,0 +1,20 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+from app import reset_timer_end
+
+
+def settings_db(**values):
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute("CREATE TABLE settings (setting_key TEXT PRIMARY KEY, setting_value TEXT)")
+    conn.executemany("INSERT INTO settings VALUES (?,?)", values.items())
+    return conn
+
+
+def test_reset_timer_end_treats_invalid_stored_units_as_zero():
+    # update-settings used to store any string, so an upgraded database can hold these
+    conn = settings_db(game_timer_hours='1.5', game_timer_minutes='30', game_timer_seconds='abc')
+    reset_timer_end(conn, 'game_timer')
+    end = conn.execute("SELECT setting_value FROM settings WHERE setting_key='game_timer_end'").fetchone()[0]
+    assert timedelta(minutes=29) < datetime.fromisoformat(end) - datetime.now() <= timedelta(minutes=30)